@@ -74,6 +74,8 @@ def _default_config():
             "retry_interval": DEFAULT_ELASTICSEARCH_RETRY_INTERVAL,
             "retry_on_timeout": True,
             "request_timeout": 120,
+            "http_compress": False,
+            "connections_per_node": 10,
             "max_wait_duration": 120,
             "initial_backoff_duration": 1,
             "backoff_multiplier": 2,
@@ -9,12 +9,18 @@ import os
 import time
 from enum import Enum
 
+import orjson
 from elastic_transport import ConnectionTimeout
 from elastic_transport.client_utils import url_to_node_config
 from elasticsearch import ApiError, AsyncElasticsearch, ConflictError
 from elasticsearch import (
     ConnectionError as ElasticConnectionError,
 )
+from elasticsearch.serializer import (
+    JsonSerializer,
+    NdjsonSerializer,
+    OrjsonSerializer,
+)
 
 from connectors import __version__
 from connectors.config import (
@@ -43,6 +49,35 @@ class License(Enum):
 USER_AGENT_BASE = f"elastic-connectors-{__version__}"
 
 
+class LenientOrjsonSerializer(OrjsonSerializer):
+    """JSON serializer relying on orjson.
+
+    Unlike the default orjson serializer, it accepts non-string dict keys,
+    which the standard library `json` module silently converts to strings.
+    Data orjson refuses, such as lone surrogates or integers wider than 64 bits,
+    is serialized with the standard library `json` module instead.
+    """
+
+    def json_dumps(self, data):
+        try:
+            return orjson.dumps(
+                data, default=self.default, option=orjson.OPT_NON_STR_KEYS
+            )
+        except orjson.JSONEncodeError:
+            return JsonSerializer.json_dumps(self, data)
+
+
+class OrjsonNdjsonSerializer(NdjsonSerializer, LenientOrjsonSerializer):
+    """NDJSON serializer used for `_bulk` bodies, serializing each line with orjson."""
+
+
+# only the `_bulk` bodies go through orjson, JSON requests and responses keep
+# using the default serializer
+SERIALIZERS = {
+    OrjsonNdjsonSerializer.mimetype: OrjsonNdjsonSerializer(),
+}
+
+
 class ESClient:
     user_agent = f"{USER_AGENT_BASE}/service"
 
@@ -67,6 +102,9 @@ class ESClient:
             "hosts": [self.host],
             "request_timeout": config.get("request_timeout", 120),
             "retry_on_timeout": config.get("retry_on_timeout", True),
+            "http_compress": config.get("http_compress", False),
+            "connections_per_node": config.get("connections_per_node", 10),
+            "serializers": SERIALIZERS,
         }
         logger.debug(f"Initial Elasticsearch node configuration is {self.host}")
 
@@ -157,15 +195,15 @@ class ESClient:
 
     async def wait(self):
         backoff = self.initial_backoff_duration
-        start = time.time()
+        start = time.perf_counter()
         logger.debug(f"Wait for Elasticsearch (max: {self.max_wait_duration})")
-        while time.time() - start < self.max_wait_duration:
+        while time.perf_counter() - start < self.max_wait_duration:
             if not self._keep_waiting:
                 await self.close()
                 return False
 
             logger.info(
-                f"Waiting for Elasticsearch at {self.configured_host} (so far: {int(time.time() - start)} secs)"
+                f"Waiting for Elasticsearch at {self.configured_host} (so far: {int(time.perf_counter() - start)} secs)"
             )
             logger.debug(
                 f"Seed node configuration: {self.client.transport.node_pool._seed_nodes}"
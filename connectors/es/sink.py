@@ -18,9 +18,9 @@ Elasticsearch <== Sink <== queue <== Extractor <== generator
 
 """
 import asyncio
-import copy
 import functools
 import logging
+import sys
 import time
 
 from connectors.config import (
@@ -64,6 +64,7 @@ OP_CREATE = "create"
 OP_UPDATE = "update"
 OP_UNKNOWN = "operation_unknown"
 CANCELATION_TIMEOUT = 5
+MIN_CHUNK_SIZE = 50
 
 # counter keys
 BIN_DOCS_DOWNLOADED = "binary_docs_downloaded"
@@ -82,6 +83,9 @@ RESULT_UNDEFINED = "results_undefined"
 ID_CHANGED_AFTER_REQUEST = "_ids_changed_after_request"
 ID_DUPLICATE = "_id_duplicates"
 
+# marks a document id that is not in the content index yet
+NOT_INDEXED = object()
+
 # Successful results according to the docs: https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html#bulk-api-response-body
 SUCCESSFUL_RESULTS = ("created", "deleted", "updated")
 
@@ -124,6 +128,8 @@ class Sink:
     - `pipeline` -- ingest pipeline settings to pass to the bulk API
     - `chunk_mem_size` -- a maximum size in MiB for each bulk request
     - `max_concurrency` -- a maximum number of concurrent bulk requests
+    - `min_chunk_size` -- the number of operations per request never goes below this
+      value when Elasticsearch rejects operations -- default: `MIN_CHUNK_SIZE`
     """
 
     def __init__(
@@ -138,10 +144,13 @@ class Sink:
         retry_interval,
         logger_=None,
         enable_bulk_operations_logging=False,
+        min_chunk_size=MIN_CHUNK_SIZE,
     ):
         self.client = client
         self.queue = queue
         self.chunk_size = chunk_size
+        self.max_chunk_size = chunk_size
+        self.min_chunk_size = min(min_chunk_size, chunk_size)
         self.pipeline = pipeline
         self.chunk_mem_size = chunk_mem_size * 1024 * 1024
         self.bulk_tasks = ConcurrentTasks(max_concurrency=max_concurrency)
@@ -188,37 +197,51 @@ class Sink:
 
         # TODO: retry 429s for individual items here
         res = await self.client.bulk_insert(operations, self.pipeline["name"])
-        ids_to_ops = self._map_id_to_op(operations)
+        ids_to_ops = self._map_id_to_op(stats)
         await self._process_bulk_response(
             res, ids_to_ops, do_log=self._enable_bulk_operations_logging
         )
 
+        rejected = 0
         if res.get("errors"):
             for item in res["items"]:
                 for op, data in item.items():
                     if "error" in data:
                         self._logger.error(f"operation {op} failed, {data['error']}")
+                        if data.get("status") == 429:
+                            rejected += 1
 
+        self._adapt_chunk_size(rejected)
         self._populate_stats(stats, res)
 
         return res
 
-    def _map_id_to_op(self, operations):
+    def _adapt_chunk_size(self, rejected):
+        """Adapts the number of operations per request to the load of Elasticsearch.
+
+        The chunk size is halved when Elasticsearch rejects operations with a 429 status,
+        and grows back by a tenth of the configured chunk size after each request
+        without rejections.
+        """
+        if rejected:
+            chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+            if chunk_size < self.chunk_size:
+                self._logger.warning(
+                    f"Elasticsearch rejected {rejected} operations, reducing bulk chunk size to {chunk_size}"
+                )
+            self.chunk_size = chunk_size
+        elif self.chunk_size < self.max_chunk_size:
+            self.chunk_size = min(
+                self.chunk_size + max(self.max_chunk_size // 10, 1),
+                self.max_chunk_size,
+            )
+
+    def _map_id_to_op(self, stats):
         """
-        Takes operations like: [{operation: {"_index": index, "_id": doc_id}}, doc["doc"]]
+        Takes the stats of a batch like: {operation: {doc_id: size}}
         and turns them into { doc_id : operation }
         """
-        result = {}
-        for entry in operations:
-            if len(entry.keys()) == 1:  # only looking at "operation" entries
-                for op, doc in entry.items():
-                    if (
-                        isinstance(doc, dict)
-                        and "_id" in doc.keys()
-                        and "_index" in doc.keys()
-                    ):  # avoiding update bulk extra entries
-                        result[doc["_id"]] = op
-        return result
+        return {doc_id: op for op, sizes in stats.items() for doc_id in sizes}
 
     async def _process_bulk_response(self, res, ids_to_ops, do_log=False):
         for item in res.get("items", []):
@@ -343,6 +366,9 @@ class Sink:
 
         Bulk calls are executed concurrently with a maximum number of concurrent
         requests.
+
+        The loop does not yield control on every item: it does so when the queue
+        is empty or when the maximum number of concurrent requests is reached.
         """
         try:
             batch = []
@@ -380,24 +406,24 @@ class Sink:
 
                 bulk_size += doc_size
                 if len(batch) >= self.chunk_size or bulk_size > self.chunk_mem_size:
+                    # the bulk task owns the batch and its stats from now on
                     await self.bulk_tasks.put(
-                        functools.partial(
-                            self._batch_bulk,
-                            copy.copy(batch),
-                            copy.copy(stats),
-                        ),
+                        functools.partial(self._batch_bulk, batch, stats),
                         name=f"Elasticsearch Sink: _bulk batch #{batch_num}",
                     )
-                    batch.clear()
+                    batch = []
                     stats = {OP_INDEX: {}, OP_UPDATE: {}, OP_DELETE: {}}
                     bulk_size = 0
 
-                await asyncio.sleep(0)
                 self.bulk_tasks.raise_any_exception()
 
-            await self.bulk_tasks.join(raise_on_error=True)
             if len(batch) > 0:
-                await self._batch_bulk(batch, stats)
+                # send the last batch alongside the in-flight ones rather than after them
+                await self.bulk_tasks.put(
+                    functools.partial(self._batch_bulk, batch, stats),
+                    name=f"Elasticsearch Sink: _bulk batch #{batch_num}",
+                )
+            await self.bulk_tasks.join(raise_on_error=True)
         except Exception as e:
             self.error = e
             raise
@@ -437,7 +463,6 @@ class Extractor:
         self.client = client
         self.queue = queue
         self.index = index
-        self.loop = asyncio.get_event_loop()
         self.counters = Counters()
         self.error = None
         self.filter_ = filter_
@@ -474,11 +499,11 @@ class Extractor:
     def force_cancel(self):
         self._canceled = True
 
-    async def put_doc(self, doc):
+    async def put_doc(self, doc, doc_size=None):
         if self._canceled:
             raise ForceCanceledError
 
-        await self.queue.put(doc)
+        await self.queue.put(doc, item_size=doc_size)
 
     async def run(self, generator, job_type):
         try:
@@ -530,7 +555,10 @@ class Extractor:
            skip_unchanged_documents (bool): if True, will skip documents that have not changed since last sync
         """
         generator = self._decorate_with_metrics_span(generator)
-        existing_ids = await self._load_existing_docs()
+        # existing ids are collected while the first documents are fetched
+        # from the source, and only awaited when they are needed
+        existing_ids_task = asyncio.create_task(self._load_existing_docs())
+        existing_ids = None
 
         self._logger.info("Iterating on remote documents")
         lazy_downloads = ConcurrentTasks(self.concurrent_downloads)
@@ -550,22 +578,18 @@ class Extractor:
                     self.counters.increment((DOCS_FILTERED))
                     continue
 
-                if doc_id in existing_ids:
-                    # pop out of existing_ids, so they do not get deleted
-                    ts = existing_ids.pop(doc_id)
+                if existing_ids is None:
+                    existing_ids = await existing_ids_task
 
+                # pop out of existing_ids, so they do not get deleted
+                ts = existing_ids.pop(doc_id, NOT_INDEXED)
+                if ts is not NOT_INDEXED:
                     if (
                         skip_unchanged_documents
-                        and TIMESTAMP_FIELD in doc
-                        and ts == doc[TIMESTAMP_FIELD]
+                        and ts is not None
+                        and ts == doc.get(TIMESTAMP_FIELD)
                     ):
-                        # cancel the download
-                        if (
-                            self.content_extraction_enabled
-                            and lazy_download is not None
-                        ):
-                            await lazy_download(doit=False)
-
+                        # nothing to update, and no content to download
                         self._logger.debug(
                             f"Skipping document with id '{doc_id}' because field '{TIMESTAMP_FIELD}' has not changed since last sync"
                         )
@@ -598,17 +622,26 @@ class Extractor:
                             "doc": doc,
                         }
                     )
-
-                await asyncio.sleep(0)
+        except:
+            self._discard_existing_ids_task(existing_ids_task)
+            raise
         finally:
             # wait for all downloads to be finished
             await lazy_downloads.join()
 
+        existing_ids = await existing_ids_task
         await self.enqueue_docs_to_delete(existing_ids)
         await self.put_doc(END_DOCS)
 
+    def _discard_existing_ids_task(self, existing_ids_task):
+        if not existing_ids_task.done():
+            existing_ids_task.cancel()
+        elif not existing_ids_task.cancelled():
+            # retrieve the scan error so that it is not reported as never retrieved
+            existing_ids_task.exception()
+
     async def _load_existing_docs(self):
-        start = time.time()
+        start = time.perf_counter()
         self._logger.info("Collecting local document ids")
 
         existing_ids = {
@@ -620,7 +653,7 @@ class Extractor:
 
         self._logger.debug(
             f"Found {len(existing_ids)} docs in {self.index} (duration "
-            f"{int(time.time() - start)} seconds) "
+            f"{int(time.perf_counter() - start)} seconds) "
         )
 
         if self._logger.isEnabledFor(logging.DEBUG):
@@ -688,8 +721,6 @@ class Extractor:
                     if operation in (OP_INDEX, OP_UPDATE):
                         item["doc"] = doc
                     await self.put_doc(item)
-
-                await asyncio.sleep(0)
         finally:
             # wait for all downloads to be finished
             await lazy_downloads.join()
@@ -703,74 +734,78 @@ class Extractor:
         """
         self._logger.info("Starting access control doc lookups")
         generator = self._decorate_with_metrics_span(generator)
+        # existing ids are collected while the first documents are fetched
+        # from the source, and only awaited when they are needed
+        existing_ids_task = asyncio.create_task(self._load_existing_docs())
+        existing_ids = None
 
-        existing_ids = {
-            doc_id: last_update_timestamp
-            async for (
-                doc_id,
-                last_update_timestamp,
-            ) in self.client.yield_existing_documents_metadata(self.index)
-        }
+        count = 0
+        try:
+            async for doc in generator:
+                doc, _, _ = doc
+                count += 1
+                if count % self.display_every == 0:
+                    self._log_progress()
 
-        if self._logger.isEnabledFor(logging.DEBUG):
-            self._logger.debug(
-                f"Size of {len(existing_ids)} access control document ids  in memory is {get_mib_size(existing_ids)}MiB"
-            )
+                doc_id = doc["id"] = doc.pop("_id")
 
-        count = 0
-        async for doc in generator:
-            doc, _, _ = doc
-            count += 1
-            if count % self.display_every == 0:
-                self._log_progress()
-
-            doc_id = doc["id"] = doc.pop("_id")
-            doc_exists = doc_id in existing_ids
-
-            if doc_exists:
-                last_update_timestamp = existing_ids.pop(doc_id)
-                doc_not_updated = (
-                    TIMESTAMP_FIELD in doc
-                    and last_update_timestamp == doc[TIMESTAMP_FIELD]
-                )
+                if existing_ids is None:
+                    existing_ids = await existing_ids_task
 
-                if doc_not_updated:
-                    continue
+                last_update_timestamp = existing_ids.pop(doc_id, NOT_INDEXED)
 
-                self.counters.increment(UPDATES_QUEUED)
+                if last_update_timestamp is not NOT_INDEXED:
+                    doc_not_updated = (
+                        last_update_timestamp is not None
+                        and last_update_timestamp == doc.get(TIMESTAMP_FIELD)
+                    )
 
-                operation = OP_UPDATE
-            else:
-                self.counters.increment(CREATES_QUEUED)
+                    if doc_not_updated:
+                        continue
 
-                if TIMESTAMP_FIELD not in doc:
-                    doc[TIMESTAMP_FIELD] = iso_utc()
+                    self.counters.increment(UPDATES_QUEUED)
 
-                operation = OP_INDEX
+                    operation = OP_UPDATE
+                else:
+                    self.counters.increment(CREATES_QUEUED)
 
-            await self.put_doc(
-                {
-                    "_op_type": operation,
-                    "_index": self.index,
-                    "_id": doc_id,
-                    "doc": doc,
-                }
-            )
-            await asyncio.sleep(0)
+                    if TIMESTAMP_FIELD not in doc:
+                        doc[TIMESTAMP_FIELD] = iso_utc()
+
+                    operation = OP_INDEX
+
+                await self.put_doc(
+                    {
+                        "_op_type": operation,
+                        "_index": self.index,
+                        "_id": doc_id,
+                        "doc": doc,
+                    }
+                )
+        except:
+            self._discard_existing_ids_task(existing_ids_task)
+            raise
 
+        existing_ids = await existing_ids_task
         await self.enqueue_docs_to_delete(existing_ids)
         await self.put_doc(END_DOCS)
 
     async def enqueue_docs_to_delete(self, existing_ids):
         self._logger.debug(f"Delete {len(existing_ids)} docs from index '{self.index}'")
+        # delete operations only differ by their id, so the rest of the operation
+        # is measured once and the size of each id is added to it
+        empty_id = ""
+        op_overhead = get_size(
+            {"_op_type": OP_DELETE, "_index": self.index, "_id": empty_id}
+        )
+        op_overhead -= sys.getsizeof(empty_id)
         for doc_id in existing_ids.keys():
-            await self.put_doc(
-                {
-                    "_op_type": OP_DELETE,
-                    "_index": self.index,
-                    "_id": doc_id,
-                }
-            )
+            op = {
+                "_op_type": OP_DELETE,
+                "_index": self.index,
+                "_id": doc_id,
+            }
+            await self.put_doc(op, doc_size=op_overhead + sys.getsizeof(doc_id))
             self.counters.increment(DELETES_QUEUED)
 
     def _log_progress(
@@ -807,7 +842,6 @@ class SyncOrchestrator:
         self._logger = logger_ or logger
         self._logger.debug(f"SyncOrchestrator connecting to {elastic_config['host']}")
         self.es_management_client = ESManagementClient(elastic_config)
-        self.loop = asyncio.get_event_loop()
         self._extractor = None
         self._extractor_task = None
         self._sink = None
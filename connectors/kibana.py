@@ -170,8 +170,6 @@ async def upsert_index(es, index):
     If the index with such name exists, it's deleted and then created again
     with provided mappings and settings. Otherwise index is just created.
 
-    After that, provided docs are inserted into the index.
-
     This method is supposed to be used only for testing - framework is not
     supposed to create/delete indices at all, Kibana is responsible for
     this logic.
@@ -215,13 +215,13 @@ def timed_execution(name, func_name, slow_log=None, canceled=None):
     - canceled: if provided a callable to cancel the timer. Used in nested
       calls.
     """
-    start = time.time()
+    start = time.perf_counter()
     try:
         yield
     finally:
         do_not_track = canceled is not None and canceled()
         if not do_not_track:
-            delta = time.time() - start
+            delta = time.perf_counter() - start
             if slow_log is None or (slow_log is not None and delta > slow_log):
                 logger.debug(  # pyright: ignore
                     f"[{name}] {func_name} took {delta} seconds."
@@ -140,7 +140,7 @@ class SyncJobRunner:
                 if self.sync_job.job_type == JobType.INCREMENTAL
                 else None
             )
-            self._start_time = time.time()
+            self._start_time = time.perf_counter()
             await self.sync_job.claim(sync_cursor=sync_cursor)
 
             self.sync_job.log_debug("Successfully claimed the sync job.")
@@ -396,7 +396,7 @@ class SyncJobRunner:
             f"created: {ingestion_stats.get(CREATES_QUEUED, 0)} | "
             f"updated: {ingestion_stats.get(UPDATES_QUEUED, 0)} | "
             f"deleted: {ingestion_stats.get(DELETES_QUEUED, 0)} "
-            f"(took {int(time.time() - self._start_time)} seconds)"  # pyright: ignore
+            f"(took {int(time.perf_counter() - self._start_time)} seconds)"  # pyright: ignore
         )
         self.log_counters(ingestion_stats)
 
@@ -323,9 +323,9 @@ class MemQueue(asyncio.Queue):
 
     async def _putter_timeout(self, putter):
         """This coroutine will set the result of the putter to QueueFull when a certain timeout it reached."""
-        start = time.time()
+        start = time.perf_counter()
         while not putter.done():
-            elapsed_time = time.time() - start
+            elapsed_time = time.perf_counter() - start
             if elapsed_time >= self.refresh_timeout:
                 putter.set_result(
                     asyncio.QueueFull(
@@ -336,14 +336,16 @@ class MemQueue(asyncio.Queue):
             logger.debug("Queue Full")
             await asyncio.sleep(self.refresh_interval)
 
-    async def put(self, item):
-        item_size = get_size(item)
+    async def put(self, item, item_size=None):
+        # callers can pass a precomputed item_size to skip get_size
+        if item_size is None:
+            item_size = get_size(item)
 
         # This block is taken from the original put() method but with two
         # changes:
         #
         # 1/ full() takes the new item size to decide if we're going over the
-        #    max size, so we do a single call on `get_size` per item
+        #    max size, so we do at most a single call on `get_size` per item
         #
         # 2/ when the putter is done, we check if the result is QueueFull.
         #    if it's the case, we re-raise it here
@@ -358,9 +360,7 @@ class MemQueue(asyncio.Queue):
             #
             # This mechanism ensures that we serialize put() calls when the queue is full.
             putter = self._get_loop().create_future()  # pyright: ignore
-            putter_timeout = self._get_loop().create_task(  # pyright: ignore
-                self._putter_timeout(putter)
-            )
+            putter_timeout = asyncio.create_task(self._putter_timeout(putter))
             self._putters.append(putter)  # pyright: ignore
             try:
                 result = await putter
@@ -4,6 +4,7 @@
 # you may not use this file except in compliance with the Elastic License 2.0.
 #
 import base64
+import datetime
 from functools import cached_property
 from unittest import mock
 from unittest.mock import AsyncMock, Mock
@@ -15,6 +16,7 @@ from connectors import __version__
 from connectors.es.client import (
     ESClient,
     License,
+    OrjsonNdjsonSerializer,
     RetryInterruptedError,
     TransientElasticsearchRetrier,
     with_concurrency_control,
@@ -56,6 +58,34 @@ async def test_with_concurrency_control():
     assert mock_func.call_count == 1
 
 
+def test_orjson_ndjson_serializer():
+    serializer = OrjsonNdjsonSerializer()
+    operations = [
+        {"index": {"_index": "search-index", "_id": "1"}},
+        {"title": "doc", "_timestamp": datetime.datetime(2023, 1, 1), 1: "one"},
+    ]
+
+    assert serializer.dumps(operations) == (
+        b'{"index":{"_index":"search-index","_id":"1"}}\n'
+        b'{"title":"doc","_timestamp":"2023-01-01T00:00:00","1":"one"}\n'
+    )
+
+    # payloads orjson refuses are serialized with the json module instead
+    operations = [
+        {"index": {"_index": "search-index", "_id": "1"}},
+        {"title": "bad \ud800"},
+        {"index": {"_index": "search-index", "_id": "2"}},
+        {"size": 2**70},
+    ]
+
+    assert serializer.dumps(operations) == (
+        b'{"index":{"_index":"search-index","_id":"1"}}\n'
+        b'{"title":"bad \xed\xa0\x80"}\n'
+        b'{"index":{"_index":"search-index","_id":"2"}}\n'
+        b'{"size":1180591620717411303424}\n'
+    )
+
+
 class TestESClient:
     @pytest.mark.parametrize(
         "enabled_license, licenses_enabled",
@@ -164,6 +194,22 @@ class TestESClient:
         basic = f"Basic {base64.b64encode(b'elastic:changeme').decode()}"
         assert es_client.client._headers["Authorization"] == basic
 
+        serializers = es_client.client.transport.serializers.serializers
+        assert isinstance(serializers["application/x-ndjson"], OrjsonNdjsonSerializer)
+        # responses are decoded with the standard library json module
+        assert serializers["application/json"].loads(
+            b'{"_source":{"id":"bad \xed\xa0\x80"}}'
+        ) == {"_source": {"id": "bad \ud800"}}
+
+    def test_esclient_connection_options(self):
+        es_client = ESClient(
+            BASIC_CONFIG | {"http_compress": True, "connections_per_node": 20}
+        )
+
+        node = es_client.client.transport.node_pool.all()[0]
+        assert node.config.http_compress
+        assert node.config.connections_per_node == 20
+
     @pytest.mark.asyncio
     async def test_es_client_auth_error(self, mock_responses, patch_logger):
         headers = {"X-Elastic-Product": "Elasticsearch"}
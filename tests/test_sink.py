@@ -5,8 +5,10 @@
 #
 import asyncio
 import datetime
+import gc
 import itertools
 import json
+import sys
 from copy import deepcopy
 from unittest import mock
 from unittest.mock import ANY, AsyncMock, Mock, call
@@ -24,6 +26,7 @@ from connectors.es.sink import (
     CREATES_QUEUED,
     DELETES_QUEUED,
     DOCS_EXTRACTED,
+    ID_CHANGED_AFTER_REQUEST,
     OP_DELETE,
     OP_INDEX,
     OP_UPDATE,
@@ -42,6 +45,7 @@ from connectors.protocol.connectors import (
     INDEXED_DOCUMENT_COUNT,
     INDEXED_DOCUMENT_VOLUME,
 )
+from connectors.utils import get_size
 from tests.commons import AsyncIterator
 
 INDEX = "some-index"
@@ -425,7 +429,8 @@ def lazy_download_fake(doc):
 
 def queue_called_with_operations(queue, operations):
     expected_calls = [call(operation) for operation in operations]
-    actual_calls = queue.put.call_args_list
+    # only compare the operations, delete operations are put with a precomputed size
+    actual_calls = [call(*put_call.args) for put_call in queue.put.call_args_list]
 
     return actual_calls == expected_calls and queue.put.call_count == len(
         expected_calls
@@ -753,6 +758,54 @@ async def test_get_docs(
         assert queue_called_with_operations(queue, expected_queue_operations)
 
 
+@mock.patch(
+    "connectors.es.management_client.ESManagementClient.yield_existing_documents_metadata"
+)
+@pytest.mark.asyncio
+async def test_get_docs_skips_unchanged_docs_without_downloading(
+    yield_existing_documents_metadata,
+):
+    yield_existing_documents_metadata.return_value = AsyncIterator(
+        [(DOC_ONE["_id"], DOC_ONE["_timestamp"])]
+    )
+    lazy_download = AsyncMock()
+    queue = await queue_mock()
+    extractor = await setup_extractor(queue, content_extraction_enabled=True)
+
+    await extractor.get_docs(
+        AsyncIterator([(deepcopy(DOC_ONE), lazy_download, "index")]),
+        skip_unchanged_documents=True,
+    )
+
+    lazy_download.assert_not_awaited()
+    assert extractor.counters.get(UPDATES_QUEUED) == 0
+    assert queue_called_with_operations(queue, [end_docs_operation()])
+
+
+@mock.patch(
+    "connectors.es.management_client.ESManagementClient.yield_existing_documents_metadata"
+)
+@pytest.mark.asyncio
+async def test_get_docs_updates_docs_without_timestamp_when_skipping_unchanged(
+    yield_existing_documents_metadata,
+):
+    doc = {"_id": DOC_ONE_ID, "_timestamp": None}
+    yield_existing_documents_metadata.return_value = AsyncIterator([(DOC_ONE_ID, None)])
+    queue = await queue_mock()
+    extractor = await setup_extractor(queue)
+
+    await extractor.get_docs(
+        AsyncIterator([(deepcopy(doc), None, "index")]),
+        skip_unchanged_documents=True,
+    )
+
+    # a missing timestamp on both sides does not tell the doc is unchanged
+    assert extractor.counters.get(UPDATES_QUEUED) == 1
+    assert queue_called_with_operations(
+        queue, [index_operation(doc), end_docs_operation()]
+    )
+
+
 @pytest.mark.parametrize(
     "docs_from_source, doc_should_ingest, sync_rules_enabled, content_extraction_enabled, expected_queue_operations, "
     "expected_total_docs_updated, expected_total_docs_created, expected_total_docs_deleted, expected_total_downloads",
@@ -999,6 +1052,18 @@ async def test_get_docs_incrementally(
             created(1),
             deleted(1),
         ),
+        (
+            # doc 1 has no timestamp in the index nor in the source -> update doc 1
+            [{"_id": DOC_ONE_ID, "_timestamp": None}],
+            [({"_id": DOC_ONE_ID, "_timestamp": None}, None, None)],
+            [
+                update_operation({"_id": DOC_ONE_ID, "_timestamp": None}),
+                end_docs_operation(),
+            ],
+            updated(1),
+            created(0),
+            deleted(0),
+        ),
     ],
 )
 @mock.patch(
@@ -1257,7 +1322,7 @@ async def test_extractor_put_doc():
     )
 
     await extractor.put_doc(doc)
-    queue.put.assert_awaited_once_with(doc)
+    queue.put.assert_awaited_once_with(doc, item_size=None)
 
 
 @pytest.mark.asyncio
@@ -1430,7 +1495,7 @@ async def test_extractor_run_when_mem_full_is_raised():
     queue = await queue_mock()
     queue.clear = Mock()
 
-    def _put_side_effect(value):
+    def _put_side_effect(value, item_size=None):
         if isinstance(value, str):
             pass
         else:
@@ -1634,3 +1699,238 @@ async def test_should_log_error_when_unknown_action_item_returned(patch_logger):
     patch_logger.assert_present(
         successful_action_log_message(DOC_ONE_ID, "create", "created")
     )
+
+
+@pytest.mark.asyncio
+async def test_sink_sends_last_batch_with_in_flight_batches():
+    docs = [
+        (0, {"_op_type": OP_INDEX, "_index": INDEX, "_id": "1", "doc": {"id": "1"}}),
+        (0, {"_op_type": OP_INDEX, "_index": INDEX, "_id": "2", "doc": {"id": "2"}}),
+        (0, {"_op_type": OP_DELETE, "_index": INDEX, "_id": "3"}),
+        (0, end_docs_operation()),
+    ]
+    queue = Mock()
+    queue.get = AsyncMock(side_effect=docs)
+    calls = []
+
+    async def _bulk_insert(operations, pipeline):
+        calls.append("start")
+        if len(calls) == 1:
+            # keep the first batch in flight
+            await asyncio.sleep(0.05)
+        calls.append("end")
+        return {"items": []}
+
+    client = Mock()
+    client.bulk_insert = AsyncMock(side_effect=_bulk_insert)
+    sink = Sink(
+        client=client,
+        queue=queue,
+        chunk_size=4,
+        pipeline={"name": "pipeline"},
+        chunk_mem_size=10,
+        max_concurrency=5,
+        max_retries=3,
+        retry_interval=10,
+    )
+
+    await sink.run()
+
+    assert calls == ["start", "start", "end", "end"]
+    assert sink.counters.get(f"{BULK_OPERATIONS}.{OP_INDEX}") == 2
+    assert sink.counters.get(f"{BULK_OPERATIONS}.{OP_DELETE}") == 1
+
+
+@pytest.mark.parametrize("job_type", [JobType.FULL, JobType.ACCESS_CONTROL])
+@pytest.mark.asyncio
+async def test_extractor_collects_existing_ids_while_fetching_first_docs(job_type):
+    events = []
+
+    async def _existing_docs(index):
+        events.append("scan started")
+        await asyncio.sleep(0)
+        events.append("scan done")
+        yield DOC_TWO_ID, TIMESTAMP
+
+    async def _source_docs():
+        events.append("source started")
+        await asyncio.sleep(0)
+        yield deepcopy(DOC_ONE), None, OP_INDEX
+
+    es_client = Mock()
+    es_client.yield_existing_documents_metadata = _existing_docs
+    queue = await queue_mock()
+    extractor = Extractor(es_client, queue, INDEX)
+
+    await extractor.run(_source_docs(), job_type)
+
+    assert events.index("source started") < events.index("scan done")
+    assert queue_called_with_operations(
+        queue,
+        [index_operation(DOC_ONE), delete_operation(DOC_TWO), end_docs_operation()],
+    )
+
+
+@pytest.mark.parametrize("job_type", [JobType.FULL, JobType.ACCESS_CONTROL])
+@pytest.mark.asyncio
+async def test_extractor_cancels_existing_ids_scan_when_source_fails(job_type):
+    events = []
+    error = Exception("source failed")
+
+    async def _existing_docs(index):
+        events.append("scan started")
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            events.append("scan canceled")
+            raise
+        yield DOC_TWO_ID, TIMESTAMP
+
+    async def _source_docs():
+        await asyncio.sleep(0)
+        raise error
+        yield
+
+    es_client = Mock()
+    es_client.yield_existing_documents_metadata = _existing_docs
+    queue = await queue_mock()
+    extractor = Extractor(es_client, queue, INDEX)
+
+    await extractor.run(_source_docs(), job_type)
+    await asyncio.sleep(0)
+
+    assert events == ["scan started", "scan canceled"]
+    assert extractor.error is error
+    assert queue_called_with_operations(queue, ["EXTRACTOR_ERROR"])
+
+
+@pytest.mark.parametrize("job_type", [JobType.FULL, JobType.ACCESS_CONTROL])
+@pytest.mark.asyncio
+async def test_extractor_retrieves_failed_existing_ids_scan_when_source_fails(
+    job_type,
+):
+    scan_error = Exception("scan failed")
+    source_error = Exception("source failed")
+
+    async def _existing_docs(index):
+        raise scan_error
+        yield
+
+    async def _source_docs():
+        await asyncio.sleep(0)
+        raise source_error
+        yield
+
+    loop = asyncio.get_running_loop()
+    exception_handler = Mock()
+    loop.set_exception_handler(exception_handler)
+    es_client = Mock()
+    es_client.yield_existing_documents_metadata = _existing_docs
+    queue = await queue_mock()
+    extractor = Extractor(es_client, queue, INDEX)
+
+    try:
+        await extractor.run(_source_docs(), job_type)
+        assert extractor.error is source_error
+        # the error traceback keeps the scan task alive, drop it to collect the task
+        del extractor
+        gc.collect()
+    finally:
+        loop.set_exception_handler(None)
+
+    exception_handler.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_batch_bulk_counts_ids_changed_after_request():
+    client = Mock()
+    client.bulk_insert = AsyncMock(
+        return_value={
+            "items": [
+                successful_bulk_action("1", "index", "created"),
+                successful_bulk_action("changed-by-pipeline", "update", "updated"),
+            ]
+        }
+    )
+    sink = Sink(
+        client=client,
+        queue=Mock(),
+        chunk_size=0,
+        pipeline={"name": "pipeline"},
+        chunk_mem_size=0,
+        max_concurrency=0,
+        max_retries=3,
+        retry_interval=10,
+    )
+
+    await sink._batch_bulk([], {OP_INDEX: {"1": 1}, OP_UPDATE: {"2": 1}, OP_DELETE: {}})
+
+    assert sink.counters.get(f"{BULK_RESPONSES}.{ID_CHANGED_AFTER_REQUEST}") == 1
+
+
+@pytest.mark.asyncio
+async def test_batch_bulk_adapts_chunk_size_to_rejections():
+    rejected = {"index": {"_id": "1", "status": 429, "error": "rejected"}}
+    client = Mock()
+    client.bulk_insert = AsyncMock(
+        side_effect=[
+            {"errors": True, "items": [rejected]},
+            {"errors": True, "items": [rejected]},
+            {"errors": True, "items": [rejected]},
+            {"items": [successful_bulk_action("1", "index", "created")]},
+        ]
+    )
+    sink = Sink(
+        client=client,
+        queue=Mock(),
+        chunk_size=200,
+        pipeline={"name": "pipeline"},
+        chunk_mem_size=0,
+        max_concurrency=0,
+        max_retries=3,
+        retry_interval=10,
+        min_chunk_size=30,
+    )
+
+    chunk_sizes = []
+    for _ in range(4):
+        await sink._batch_bulk([], {OP_INDEX: {"1": 1}, OP_UPDATE: {}, OP_DELETE: {}})
+        chunk_sizes.append(sink.chunk_size)
+
+    assert chunk_sizes == [100, 50, 30, 50]
+
+
+@pytest.mark.asyncio
+async def test_enqueue_docs_to_delete_measures_a_single_operation():
+    queue = await queue_mock()
+    extractor = Extractor(None, queue, INDEX)
+
+    short_id, long_id = "1", "1" * 300
+
+    with mock.patch("connectors.es.sink.get_size", return_value=42) as get_size:
+        await extractor.enqueue_docs_to_delete(
+            {short_id: TIMESTAMP, long_id: TIMESTAMP}
+        )
+
+    get_size.assert_called_once()
+    short_size = 42 - sys.getsizeof("") + sys.getsizeof(short_id)
+    long_size = 42 - sys.getsizeof("") + sys.getsizeof(long_id)
+    assert long_size > short_size
+    assert queue.put.call_args_list == [
+        call(delete_operation({"_id": short_id}), item_size=short_size),
+        call(delete_operation({"_id": long_id}), item_size=long_size),
+    ]
+    assert extractor.counters.get(DELETES_QUEUED) == 2
+
+
+@pytest.mark.asyncio
+async def test_enqueue_docs_to_delete_sizes_follow_the_measured_operation():
+    queue = await queue_mock()
+    extractor = Extractor(None, queue, INDEX)
+    doc_ids = ["1" * 8, "1" * 300, "1" * 2000]
+
+    await extractor.enqueue_docs_to_delete(dict.fromkeys(doc_ids, TIMESTAMP))
+
+    for doc_id, put_call in zip(doc_ids, queue.put.call_args_list, strict=True):
+        measured = get_size(delete_operation({"_id": doc_id}))
+        assert put_call.kwargs["item_size"] == pytest.approx(measured, abs=8)
@@ -288,6 +288,19 @@ async def test_mem_queue_race():
     assert max_size <= get_size(item) * 2
 
 
+@pytest.mark.asyncio
+async def test_mem_queue_put_with_item_size():
+    queue = MemQueue(maxmemsize=1024)
+
+    with patch("connectors.utils.get_size") as get_size_mock:
+        await queue.put("x" * 100, item_size=10)
+
+        get_size_mock.assert_not_called()
+
+    assert queue.qmemsize() == 10
+    assert await queue.get() == (10, "x" * 100)
+
+
 @pytest.mark.asyncio
 async def test_mem_queue():
     # Initial timeout is really small so that the test is fast.